@@ -1,13 +1,21 @@
 """Models for HOMEINFO's global file database."""
 
 from __future__ import annotations
+from atexit import register
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from hashlib import sha256
+from hashlib import file_digest, sha256
+from itertools import count
 from logging import INFO, basicConfig, getLogger
+from pathlib import Path
+from shutil import copyfileobj
 from sys import stderr
+from threading import Lock
 from typing import Iterable, Iterator, Optional, Union
 
-from flask import Response
+from flask import Response, request
+from peewee import Case
 from peewee import FieldAlias
 from peewee import IntegrityError
 from peewee import ModelAlias
@@ -19,18 +27,30 @@ from peewee import Field
 from peewee import FixedCharField
 from peewee import IntegerField
 
+from werkzeug.wsgi import wrap_file
+
 from mimeutil import mimetype, mimetype_to_ext
 from peeweeplus import JSONModel, MySQLDatabaseProxy
-from wsgilib import get_range
 import os
 
-__all__ = ["META_FIELDS", "File", "cleanup"]
+__all__ = ["META_FIELDS", "File", "cleanup", "flush_touches"]
 
 
+BASEDIR = Path("/usr/share/files")
+CHUNK_SIZE = 1024 * 1024  # Buffer size for streaming responses.
 DATABASE = MySQLDatabaseProxy("filedb")
+FILE_MODE = 0o644
 LOG_FORMAT = "[%(levelname)s] %(name)s: %(message)s"
 LOGGER = getLogger("filedb")
+MIGRATE_FLUSH_COUNT = 100  # Renames flushed per bulk UPDATE.
 SHA256 = type(sha256())
+SNIFF_SIZE = 4096  # Leading bytes fed to the mimetype sniffer.
+TOUCH_FLUSH_COUNT = 64  # Queued access increments that trigger a flush.
+TRASH_DIR = BASEDIR / ".trash"
+UNLINK_WORKERS = 16
+_TMP_COUNTER = count()
+_TOUCH_LOCK = Lock()
+_TOUCH_QUEUE = defaultdict(int)
 
 
 class FileModelAlias(ModelAlias):
@@ -62,12 +82,16 @@ class File(FileDBModel):
 
 
     mimetype = CharField(255)
-    sha256sum = FixedCharField(64, unique=True)
+    sha256sum = FixedCharField(64, unique=True, collation="ascii_bin")
     size = BigIntegerField()  # File size in bytes.
     created = DateTimeField(default=datetime.now)
     last_access = DateTimeField(null=True, default=None)
     accessed = IntegerField(default=0)
     filepath=CharField(255)
+    _bytes = None  # Per-record payload cache.
+    _on_disk = None  # Per-record existence cache.
+    _path = None  # Per-record payload path cache.
+    _suffix = None  # Per-record file suffix cache.
 
     def __str__(self):
         """Converts the file to a string."""
@@ -82,47 +106,341 @@ class File(FileDBModel):
         return cls.select().where(cls.sha256sum == sha256sum).get()
 
     @classmethod
-    def _from_bytes(cls, bytes_: bytes, sha256sum: SHA256, *, save: bool) -> File:
+    def sha256sum_exists(cls, sha256sum: Union[SHA256, str]) -> bool:
+        """Checks for a digest with an index-only query.
+
+        Lets clients hash first and probe before uploading,
+        skipping redundant transfers of known payloads.
+        """
+        if isinstance(sha256sum, SHA256):
+            sha256sum = sha256sum.hexdigest()
+
+        return cls.select(cls.id).where(cls.sha256sum == sha256sum).exists()
+
+    @classmethod
+    def ident_exists(cls, ident: int) -> bool:
+        """Checks record existence by ID without hydrating the row."""
+        return cls.select(cls.id).where(cls.id == ident).exists()
+
+    @classmethod
+    def _from_bytes(
+        cls,
+        bytes_: bytes,
+        sha256sum: SHA256,
+        *,
+        mime: Optional[str] = None,
+        save: bool,
+    ) -> File:
         """Creates a new file."""
         file = cls()
-        file.mimetype = mimetype(bytes_)
+        file.mimetype = mimetype(bytes_) if mime is None else mime
         file.sha256sum = sha256sum.hexdigest()
         file.size = len(bytes_)
-        file.bytes = bytes_
+        file._store(bytes_, file.sha256sum)
         return file.save_unique() if save else file
 
     @classmethod
-    def from_bytes(cls, bytes_: bytes, *, save: bool = False) -> File:
+    def from_bytes(
+        cls, bytes_: bytes, *, mime: Optional[str] = None, save: bool = False
+    ) -> File:
         """Creates a file from the given bytes."""
         try:
             return cls.by_sha256sum(sha256sum := sha256(bytes_))
         except cls.DoesNotExist:
-            return cls._from_bytes(bytes_, sha256sum, save=save)
+            return cls._from_bytes(bytes_, sha256sum, mime=mime, save=save)
+
+    @classmethod
+    def add(
+        cls,
+        source: Union[bytes, bytearray, memoryview, Path, str, Iterator[bytes]],
+        *,
+        mime: Optional[str] = None,
+        save: bool = False,
+    ) -> File:
+        """Adds a file from bytes, a path, a file-like
+        object or an iterator of chunks.
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return cls.from_bytes(bytes(source), mime=mime, save=save)
+
+        if isinstance(source, (str, os.PathLike)):
+            return cls.from_path(source, mime=mime, save=save)
+
+        if not hasattr(source, "read"):
+            return cls.from_stream(source, mime=mime, save=save)
+
+        try:
+            seekable = source.seekable()
+        except AttributeError:
+            seekable = False
+
+        if seekable:
+            return cls._from_file(source, mime=mime, save=save)
+
+        return cls.from_stream(_iter_chunks(source), mime=mime, save=save)
+
+    @classmethod
+    def from_path(
+        cls,
+        path: Union[Path, str],
+        *,
+        mime: Optional[str] = None,
+        link: bool = False,
+        save: bool = False,
+    ) -> File:
+        """Creates a file from a file on the local filesystem.
+
+        The payload is copied in-kernel. With link=True it is
+        hardlinked instead, which avoids the copy but shares the
+        source's inode - and thus its mode, ownership and any later
+        writes through the original path - with the store.
+        """
+        path = Path(path)
+
+        with path.open("rb") as f:
+            sha256sum = file_digest(f, "sha256")
+
+            try:
+                return cls.by_sha256sum(sha256sum)
+            except cls.DoesNotExist:
+                pass
+
+            if mime is None:
+                f.seek(0)
+                mime = mimetype(f.read(SNIFF_SIZE))
+
+        file = cls()
+        file.mimetype = mime
+        file.sha256sum = sha256sum.hexdigest()
+        file.size = path.stat().st_size
+        dst = cls.storage_path(file.sha256sum)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+
+        if not dst.is_file():
+            if link:
+                try:
+                    os.link(path, dst)
+                except OSError:
+                    _copy_file(path, dst)
+            else:
+                _copy_file(path, dst)
+
+        file.filepath = str(dst)
+        file._on_disk = True
+        file._path = dst
+        return file.save_unique() if save else file
+
+    @classmethod
+    def _from_file(
+        cls, f, *, mime: Optional[str] = None, save: bool = False
+    ) -> File:
+        """Creates a file from a seekable file object without spooling."""
+        offset = f.tell()
+        sha256sum = file_digest(f, "sha256")
+
+        try:
+            return cls.by_sha256sum(sha256sum)
+        except cls.DoesNotExist:
+            pass
+
+        f.seek(offset)
+
+        if mime is None:
+            mime = mimetype(f.read(SNIFF_SIZE))
+            f.seek(offset)
+
+        file = cls()
+        file.mimetype = mime
+        file.sha256sum = sha256sum.hexdigest()
+        dst = cls.storage_path(file.sha256sum)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        BASEDIR.mkdir(parents=True, exist_ok=True)
+        tmp = BASEDIR / f".tmp-{os.getpid()}-{next(_TMP_COUNTER)}"
+
+        try:
+            with tmp.open("wb") as fdst:
+                try:
+                    while os.copy_file_range(
+                        f.fileno(), fdst.fileno(), CHUNK_SIZE
+                    ):
+                        pass
+                except OSError:  # No real descriptor or unsupported filesystem.
+                    copyfileobj(f, fdst, CHUNK_SIZE)
+
+            file.size = tmp.stat().st_size
+            os.rename(tmp, dst)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+        file.filepath = str(dst)
+        file._on_disk = True
+        file._path = dst
+        return file.save_unique() if save else file
+
+    @classmethod
+    def add_unique(cls, bytes_: bytes, *, mime: Optional[str] = None) -> File:
+        """Adds a file the caller vouches is new, skipping the dedup SELECT.
+
+        The unique digest index still backstops the claim: on a
+        collision the existing record is returned.
+        """
+        return cls._from_bytes(bytes_, sha256(bytes_), mime=mime, save=True)
+
+    @classmethod
+    def from_bytes_many(
+        cls, blobs: Iterable[bytes], *, save: bool = False
+    ) -> list[File]:
+        """Creates files from the given blobs,
+        deduplicating with a single query.
+        """
+        blobs = list(blobs)
+        digests = [sha256(blob) for blob in blobs]
+        hexdigests = {digest.hexdigest() for digest in digests}
+        records = {
+            file.sha256sum: file
+            for file in cls.select().where(cls.sha256sum.in_(hexdigests))
+        }
+        new = {}
+
+        for blob, digest in zip(blobs, digests):
+            if (hexdigest := digest.hexdigest()) not in records:
+                records[hexdigest] = new[hexdigest] = cls._from_bytes(
+                    blob, digest, save=False
+                )
+
+        if save and new:
+            cls.insert_many(
+                [
+                    {
+                        cls.mimetype: file.mimetype,
+                        cls.sha256sum: file.sha256sum,
+                        cls.size: file.size,
+                        cls.filepath: file.filepath,
+                    }
+                    for file in new.values()
+                ]
+            ).on_conflict_ignore().execute()
+            records.update(
+                (file.sha256sum, file)
+                for file in cls.select().where(cls.sha256sum.in_(set(new)))
+            )
+
+        return [records[digest.hexdigest()] for digest in digests]
+
+    @classmethod
+    def from_stream(
+        cls,
+        stream: Iterator[bytes],
+        *,
+        mime: Optional[str] = None,
+        save: bool = False,
+    ) -> File:
+        """Creates a file from the respective stream in a single pass."""
+        BASEDIR.mkdir(parents=True, exist_ok=True)
+        tmp = BASEDIR / f".tmp-{os.getpid()}-{next(_TMP_COUNTER)}"
+        sha256sum = sha256()
+        head = b""
+        size = 0
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, FILE_MODE)
+
+        try:
+            try:
+                for chunk in stream:
+                    sha256sum.update(chunk)
+                    _write_all(fd, chunk)
+
+                    if not head:
+                        head = bytes(chunk[:SNIFF_SIZE])
+
+                    size += len(chunk)
+            finally:
+                os.close(fd)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+        try:
+            file = cls.by_sha256sum(sha256sum)
+        except cls.DoesNotExist:
+            pass
+        else:
+            tmp.unlink()
+            return file
+
+        file = cls()
+        file.mimetype = mimetype(head) if mime is None else mime
+        file.sha256sum = sha256sum.hexdigest()
+        file.size = size
+        path = cls.storage_path(file.sha256sum)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(tmp, path)
+        file.filepath = str(path)
+        file._on_disk = True
+        file._path = path
+        return file.save_unique() if save else file
 
     @classmethod
-    def from_stream(cls, stream: Iterator[bytes], *, save: bool = False) -> File:
-        """Creates a file from the respective stream."""
-        return cls.from_bytes(b"".join(stream), save=save)
+    def storage_path(cls, sha256sum: str) -> Path:
+        """Returns the two-level sharded storage path for a SHA-256 sum."""
+        return BASEDIR / sha256sum[:2] / sha256sum[2:4] / sha256sum
+
+    @property
+    def path(self) -> Optional[Path]:
+        """Returns the path of the payload on disk, if any."""
+        if self._path is None and self.filepath:
+            self._path = Path(self.filepath)
+
+        return self._path
+
+    @property
+    def exists(self) -> bool:
+        """Checks via stat whether the payload is on disk, without opening it."""
+        if self._on_disk is None:
+            self._on_disk = self.path is not None and self.path.is_file()
+
+        return self._on_disk
 
     @property
     def bytes(self):
-        if self.filepath:
-            f = open(self.filepath, "rb")
-            return f.read()
+        if self._bytes is not None:
+            return self._bytes
+
+        if (path := self.path) is not None:
+            with path.open("rb", buffering=0) as f:
+                self._bytes = f.read()
+
+            return self._bytes
+
+        return None
 
     @bytes.setter
     def bytes(self, value):
+        self._store(value, sha256(value).hexdigest())
 
-        self.filepath = "/usr/share/files/" + sha256(value).hexdigest()
-        f = open(self.filepath, "wb")
-        f.write(value)
-        f.close()
+    def _store(self, value: bytes, hexdigest: str) -> None:
+        """Writes the payload to its content-addressed location."""
+        path = type(self).storage_path(hexdigest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, FILE_MODE)
 
+        try:
+            _write_all(fd, value)
+        finally:
+            os.close(fd)
+
+        self.filepath = str(path)
+        self._bytes = value
+        self._on_disk = True
+        self._path = path
 
     @bytes.deleter
     def bytes(self):
         if self.filepath:
-            os.unlink(self.filepath)
+            _discard(self.filepath)
+
+        self._bytes = None
+        self._on_disk = False
 
 
     @classmethod
@@ -130,6 +448,19 @@ class File(FileDBModel):
         """Return a file model alias."""
         return FileModelAlias(cls, alias)
 
+    @classmethod
+    def meta_by_ids(cls, idents: Iterable[int]) -> Iterator[File]:
+        """Yields metadata records for the given IDs with a single query.
+
+        Backs batch metadata endpoints: one indexed WHERE id IN (...)
+        instead of one SELECT per file.
+        """
+        return (
+            cls.select(*cls.meta_fields())
+            .where(cls.id.in_(list(idents)))
+            .iterator()
+        )
+
     @classmethod
     def meta_fields(cls) -> Iterable[Field]:
         """Returns an iterable of metadata fields."""
@@ -146,13 +477,39 @@ class File(FileDBModel):
     @property
     def suffix(self) -> str:
         """Returns the file suffix."""
-        return mimetype_to_ext(self.mimetype)
+        if self._suffix is None:
+            self._suffix = mimetype_to_ext(self.mimetype)
+
+        return self._suffix
 
     @property
     def filename(self) -> str:
         """Returns a unique file name from the SHA-256 hash and suffix."""
         return self.sha256sum + self.suffix
 
+    @classmethod
+    def scan_consistency(cls, workers: Optional[int] = None) -> list[int]:
+        """Returns the IDs of records whose payload is missing or corrupt.
+
+        Hashing runs on a thread pool: hashlib releases the GIL, so
+        independent files are digested on separate cores.
+        """
+        records = list(
+            cls.select(cls.id, cls.sha256sum, cls.filepath).tuples().iterator()
+        )
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            return [
+                ident
+                for ident, mismatch in pool.map(_check_record, records)
+                if mismatch
+            ]
+
+    def consistent(self) -> bool:
+        """Verifies the on-disk payload against the stored SHA-256 sum."""
+        with self.path.open("rb") as f:
+            return file_digest(f, "sha256").hexdigest() == self.sha256sum
+
     def save_unique(self) -> File:
         """Saves the file or returns an equivalent
         record by its SHA-256 sum.
@@ -165,45 +522,222 @@ class File(FileDBModel):
         return self
 
     def touch(self) -> None:
-        """Update access counters."""
-        self.accessed += 1
-        self.last_access = datetime.now()
-        self.save()
+        """Queue an access-counter update for a deferred, batched flush."""
+        with _TOUCH_LOCK:
+            _TOUCH_QUEUE[self.id] += 1
+            flush = sum(_TOUCH_QUEUE.values()) >= TOUCH_FLUSH_COUNT
 
-    def stream(self) -> Response:
-        """Generic WSGI function to stream a file."""
-        start, end = get_range()
+        if flush:
+            flush_touches()
+
+    def stream(self, accel_prefix: Optional[str] = None) -> Response:
+        """Generic WSGI function to stream a file.
+
+        If accel_prefix is given, the payload is not streamed through
+        Python at all: a body-less response carries an X-Accel-Redirect
+        header mapping the content-addressed path below the prefix, and
+        the reverse proxy sendfiles the bytes from disk to socket.
+        """
+        if self.sha256sum in request.if_none_match:
+            return Response(status=304)
+
+        if request.method == "HEAD":
+            response = Response(
+                status=200,
+                headers={
+                    "Content-Type": self.mimetype,
+                    "Content-Length": str(self.size),
+                    "Accept-Ranges": "bytes",
+                    "Cache-Control": "public, immutable",
+                },
+            )
+            response.set_etag(self.sha256sum)
+            return response
+
+        if accel_prefix is not None:
+            location = self.path.relative_to(BASEDIR)
+            response = Response(
+                headers={
+                    "Content-Type": self.mimetype,
+                    "X-Accel-Redirect": f"{accel_prefix.rstrip('/')}/{location}",
+                    "Cache-Control": "public, immutable",
+                }
+            )
+            response.set_etag(self.sha256sum)
+            return response
+
+        start, end = _get_range(self.size)
 
         if start >= self.size:
             start = 0
 
-        if end:
-            chunk = self.bytes[start:end]
+        f = self.path.open("rb")
+
+        if end is not None:
+            end = min(end, self.size - 1)
+            length = end - start + 1
+            body = os.pread(f.fileno(), length, start)
+            f.close()
         else:
-            chunk = self.bytes[start:]
+            length = self.size - start
+            f.seek(start)
+            body = wrap_file(request.environ, f, CHUNK_SIZE)
             end = self.size - 1
 
         response = Response(
-            chunk,
+            body,
             206,
-            mimetype=self.mimetype,
-            content_type=self.mimetype,
+            headers={
+                "Content-Type": self.mimetype,
+                "Content-Length": str(length),
+                "Content-Range": f"bytes {start}-{end}/{self.size}",
+                "Accept-Ranges": "bytes",
+                "Cache-Control": "public, immutable",
+            },
             direct_passthrough=True,
         )
-        content_range = f"bytes {start}-{end}/{self.size}"
-        response.headers.add("Content-Range", content_range)
+        response.set_etag(self.sha256sum)
         return response
 
 
 META_FIELDS = File.meta_fields()
 
 
+def flush_touches() -> None:
+    """Flush queued access-counter updates with a single UPDATE."""
+
+    with _TOUCH_LOCK:
+        if not _TOUCH_QUEUE:
+            return
+
+        queue = dict(_TOUCH_QUEUE)
+        _TOUCH_QUEUE.clear()
+
+    case = Case(File.id, [(ident, count) for ident, count in queue.items()], 0)
+    File.update(
+        accessed=File.accessed + case, last_access=datetime.now()
+    ).where(File.id.in_(list(queue))).execute()
+
+
+register(flush_touches)
+
+
+def _get_range(size: int) -> tuple[int, Optional[int]]:
+    """Parses the HTTP Range header of the current request.
+
+    Returns (start, inclusive end or None). Suffix ranges (bytes=-N)
+    are resolved against the given payload size. Invalid or
+    multi-range headers are ignored and the whole payload is served.
+    """
+
+    if not (header := request.headers.get("Range")):
+        return 0, None
+
+    unit, _, range_ = header.partition("=")
+
+    if unit.strip() != "bytes":
+        return 0, None
+
+    start, sep, end = range_.partition("-")
+    start = start.strip()
+    end = end.strip()
+
+    if not sep or (start and not start.isdigit()) or (end and not end.isdigit()):
+        return 0, None
+
+    if not start:
+        if not end:
+            return 0, None
+
+        return max(size - int(end), 0), size - 1
+
+    start = int(start)
+    end = int(end) if end else None
+
+    if end is not None and end < start:
+        return 0, None
+
+    return start, end
+
+
+def _iter_chunks(f) -> Iterator[bytes]:
+    """Yields fixed-size chunks from a file-like object."""
+
+    while chunk := f.read(CHUNK_SIZE):
+        yield chunk
+
+
+def _write_all(fd: int, value: bytes) -> None:
+    """Writes the whole buffer to the file descriptor."""
+
+    view = memoryview(value)
+
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _copy_file(src: Path, dst: Path) -> None:
+    """Copies a payload, preferring the in-kernel copy_file_range."""
+
+    with src.open("rb") as fsrc, dst.open("wb") as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), CHUNK_SIZE):
+                pass
+        except OSError:  # Cross-device link or unsupported filesystem.
+            copyfileobj(fsrc, fdst, CHUNK_SIZE)
+
+
+def _check_record(record: tuple[int, str, str]) -> tuple[int, bool]:
+    """Checks an (id, sha256sum, filepath) row against its disk payload."""
+
+    ident, sha256sum, filepath = record
+
+    if not filepath:
+        return ident, True
+
+    try:
+        with open(filepath, "rb") as f:
+            return ident, file_digest(f, "sha256").hexdigest() != sha256sum
+    except OSError:
+        return ident, True
+
+
+def _unlink(filepath: str) -> None:
+    """Remove a file from disk, logging instead of raising on failure."""
+
+    try:
+        os.unlink(filepath)
+    except OSError as error:
+        LOGGER.warning("Could not delete %s: %s", filepath, error)
+
+
+def _discard(filepath: str) -> None:
+    """Moves a payload into the trash directory for deferred deletion."""
+
+    TRASH_DIR.mkdir(parents=True, exist_ok=True)
+
+    try:
+        os.rename(filepath, TRASH_DIR / Path(filepath).name)
+    except OSError as error:
+        LOGGER.warning("Could not discard %s: %s", filepath, error)
+
+
+def empty_trash() -> None:
+    """Unlinks trashed payloads, off the hot path."""
+
+    if not TRASH_DIR.is_dir():
+        return
+
+    with ThreadPoolExecutor(max_workers=UNLINK_WORKERS) as pool:
+        pool.map(_unlink, (entry.path for entry in os.scandir(TRASH_DIR)))
+
+
 def cleanup() -> None:
     """Remove unused files in filedb."""
 
     basicConfig(level=INFO, format=LOG_FORMAT)
 
-    for file in File.select(*META_FIELDS).iterator():
+    for file in File.select(*META_FIELDS, File.filepath).iterator():
         try:
             file.delete_instance()
         except IntegrityError:
@@ -211,6 +745,46 @@ def cleanup() -> None:
         else:
             LOGGER.info("Deleted file: %i (%i bytes)", file.id, file.size)
 
+            if file.filepath:
+                _discard(file.filepath)
+
+    empty_trash()
+
+
+def migrate_shard() -> None:
+    """Move flat-directory payloads into the sharded storage layout."""
+
+    basicConfig(level=INFO, format=LOG_FORMAT)
+    migrated = []
+
+    for file in File.select(File.id, File.sha256sum, File.filepath).iterator():
+        path = File.storage_path(file.sha256sum)
+
+        if not file.filepath or file.filepath == str(path):
+            continue
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        try:
+            os.rename(file.filepath, path)
+        except OSError as error:
+            # Self-healing: an interrupted run may have renamed the
+            # payload without updating the record yet.
+            if not path.is_file():
+                LOGGER.warning("Could not migrate %s: %s", file.filepath, error)
+                continue
+
+        file.filepath = str(path)
+        migrated.append(file)
+        LOGGER.info("Migrated file: %i", file.id)
+
+        if len(migrated) >= MIGRATE_FLUSH_COUNT:
+            File.bulk_update(migrated, fields=[File.filepath])
+            migrated.clear()
+
+    if migrated:
+        File.bulk_update(migrated, fields=[File.filepath])
+
 
 def top() -> None:
     """List biggest files."""
@@ -1,12 +1,74 @@
-from filedb import File
-def dump_files():
-    for file in File.select().where(File.filepath == '').limit(10).iterator():
-        f=open("/usr/share/files/"+str(file.id),"wb")
-        f.write(file.bytes)
-        file.filepath="/usr/share/files/"+str(file.id)
-        file.save()
-        f.close()
-        print("/usr/share/files/"+str(file.id))
-
-for x in range(1,1000):
-    dump_files()
\ No newline at end of file
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from filedb import DATABASE, FILE_MODE, _write_all
+
+BATCH = 256
+WORKERS = 4
+
+
+def dump_files(last, high):
+    cursor = DATABASE.execute_sql(
+        "SELECT id, bytes FROM file"
+        " WHERE filepath = '' AND id > %s AND id <= %s"
+        " ORDER BY id LIMIT %s",
+        (last, high, BATCH),
+    )
+    pairs = []
+
+    for ident, blob in cursor:
+        path = f"/usr/share/files/{ident}"
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, FILE_MODE)
+
+        try:
+            _write_all(fd, blob)
+        finally:
+            os.close(fd)
+
+        pairs.append((ident, path))
+        print(path)
+
+    if pairs:
+        DATABASE.cursor().executemany(
+            "UPDATE file SET filepath = %s WHERE id = %s",
+            [(path, ident) for ident, path in pairs],
+        )
+
+    return pairs[-1][0] if pairs else None
+
+
+def dump_range(bounds):
+    low, high = bounds
+    last = low - 1
+    DATABASE.connect(reuse_if_open=True)
+
+    try:
+        with DATABASE.atomic():
+            while (last := dump_files(last, high)) is not None:
+                pass
+    finally:
+        DATABASE.close()
+
+
+def ranges():
+    low, high = DATABASE.execute_sql(
+        "SELECT MIN(id), MAX(id) FROM file WHERE filepath = ''"
+    ).fetchone()
+
+    if low is None:
+        return
+
+    span = (high - low) // WORKERS + 1
+
+    for start in range(low, high + 1, span):
+        yield start, min(start + span - 1, high)
+
+
+def main():
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for _ in pool.map(dump_range, ranges()):
+            pass
+
+
+if __name__ == "__main__":
+    main()